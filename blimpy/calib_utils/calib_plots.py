@@ -18,10 +18,7 @@ def get_diff(dio_cross,feedtype,**kwargs):
     I,Q,U,V = get_stokes(data,feedtype)
 
     #Fold noise diode data
-    I_OFF,I_ON = foldcal(I,tsamp,**kwargs)
-    Q_OFF,Q_ON = foldcal(Q,tsamp,**kwargs)
-    U_OFF,U_ON = foldcal(U,tsamp,**kwargs)
-    V_OFF,V_ON = foldcal(V,tsamp,**kwargs)
+    (I_OFF,Q_OFF,U_OFF,V_OFF),(I_ON,Q_ON,U_ON,V_ON) = foldcal_multi((I,Q,U,V),tsamp,**kwargs)
 
     #Do ON-OFF subtraction
     Idiff = I_ON-I_OFF
@@ -47,10 +44,7 @@ def plot_Stokes_diode(dio_cross,diff=True,feedtype='l',**kwargs):
         data = obs.data
         I,Q,U,V = get_stokes(data,feedtype)
 
-        I_OFF,I_ON = foldcal(I,tsamp,**kwargs)
-        Q_OFF,Q_ON = foldcal(Q,tsamp,**kwargs)
-        U_OFF,U_ON = foldcal(U,tsamp,**kwargs)
-        V_OFF,V_ON = foldcal(V,tsamp,**kwargs)
+        (I_OFF,Q_OFF,U_OFF,V_OFF),(I_ON,Q_ON,U_ON,V_ON) = foldcal_multi((I,Q,U,V),tsamp,**kwargs)
 
     #Plot spectra
     if diff==True:
@@ -94,10 +88,7 @@ def plot_calibrated_diode(dio_cross,chan_per_coarse=8,feedtype='l',**kwargs):
 
     #Apply the Mueller matrix to original noise diode data and refold
     I,Q,U,V = apply_Mueller(I,Q,U,V,G,psis,chan_per_coarse,feedtype)
-    I_OFF,I_ON = foldcal(I,tsamp,**kwargs)
-    Q_OFF,Q_ON = foldcal(Q,tsamp,**kwargs)
-    U_OFF,U_ON = foldcal(U,tsamp,**kwargs)
-    V_OFF,V_ON = foldcal(V,tsamp,**kwargs)
+    (I_OFF,Q_OFF,U_OFF,V_OFF),(I_ON,Q_ON,U_ON,V_ON) = foldcal_multi((I,Q,U,V),tsamp,**kwargs)
 
     #Delete data arrays for space
     I = None
@@ -183,8 +174,7 @@ def plot_gain_offsets(dio_cross,dio_chan_per_coarse=8,feedtype='l',ax1=None,ax2=
 
     #Get X and Y spectra for the noise diode ON and OFF
     #If using circular feeds these correspond to LL and RR
-    XX_OFF,XX_ON = foldcal(np.expand_dims(data[:,0,:],axis=1),tsamp,**kwargs)
-    YY_OFF,YY_ON = foldcal(np.expand_dims(data[:,1,:],axis=1),tsamp,**kwargs)
+    (XX_OFF,YY_OFF),(XX_ON,YY_ON) = foldcal_multi((data[:,0,:],data[:,1,:]),tsamp,**kwargs)
 
     if ax1==None:
         plt.subplot(211)
@@ -330,7 +320,7 @@ def plot_diodespec(ON_obs,OFF_obs,calflux,calfreq,spec_in,units='mJy',**kwargs):
     dspec = diode_spec(ON_obs,OFF_obs,calflux,calfreq,spec_in,**kwargs)
     obs = Waterfall(ON_obs,max_load=150)
     freqs = obs.populate_freqs()
-    chan_per_coarse = obs.header['nchans']/obs.calc_n_coarse_chan()
+    chan_per_coarse = obs.header['nchans']//int(obs.calc_n_coarse_chan())
     coarse_freqs = convert_to_coarse(freqs,chan_per_coarse)
     plt.ion()
     plt.figure()
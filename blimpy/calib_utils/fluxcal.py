@@ -26,22 +26,7 @@ def foldcal(data,tsamp, diode_p=0.04,numsamps=1000,switch=False,inds=False):
         Use inds=True to also return the indexes of the time series where the ND is ON and OFF
     '''
 
-    halfper = diode_p/2.0
-
-    foldt = halfper/tsamp   #number of time samples per diode switch
-
-    onesec = 1/tsamp    #number of time samples in the first second
-
-    #Find diode switches in units of time samples and round down to the nearest int
-    ints = np.arange(0,numsamps)
-    t_switch = (onesec+ints*foldt)
-    t_switch = t_switch.astype('int')
-
-    ONints = np.array(np.reshape(t_switch[:],(numsamps/2,2)))
-    ONints[:,0] = ONints[:,0]+1   #Find index ranges of ON time samples
-
-    OFFints = np.array(np.reshape(t_switch[1:-1],(numsamps/2-1,2)))
-    OFFints[:,0] = OFFints[:,0]+1   #Find index ranges of OFF time samples
+    ONints,OFFints = diode_switches(tsamp,diode_p,numsamps)
 
     av_ON = []
     av_OFF = []
@@ -65,6 +50,107 @@ def foldcal(data,tsamp, diode_p=0.04,numsamps=1000,switch=False,inds=False):
         return np.squeeze(np.mean(av_ON,axis=0)), np.squeeze(np.mean(av_OFF,axis=0))
     return np.squeeze(np.mean(av_ON,axis=0)), np.squeeze(np.mean(av_OFF,axis=0)),ONints,OFFints
 
+def diode_switches(tsamp, diode_p=0.04, numsamps=1000):
+    '''
+    Returns the index ranges of the ON and OFF time samples in a
+    calibrator measurement with flickering noise diode
+
+    Parameters
+    ----------
+    tsamp : float
+        Sampling time of data in seconds
+    diode_p : float
+        Period of the flickering noise diode in seconds
+    numsamps : int
+        Number of samples over which to average noise diode ON and OFF
+    '''
+
+    halfper = diode_p/2.0
+
+    foldt = halfper/tsamp   #number of time samples per diode switch
+
+    onesec = 1/tsamp    #number of time samples in the first second
+
+    #Find diode switches in units of time samples and round down to the nearest int
+    ints = np.arange(0,numsamps)
+    t_switch = (onesec+ints*foldt)
+    t_switch = t_switch.astype('int')
+
+    ONints = np.array(np.reshape(t_switch[:],(numsamps//2,2)))
+    ONints[:,0] = ONints[:,0]+1   #Find index ranges of ON time samples
+
+    OFFints = np.array(np.reshape(t_switch[1:-1],(numsamps//2-1,2)))
+    OFFints[:,0] = OFFints[:,0]+1   #Find index ranges of OFF time samples
+
+    return ONints,OFFints
+
+def fold_weights(n_ints, tsamp, diode_p=0.04, numsamps=1000, switch=False):
+    '''
+    Returns per time sample weights w such that np.dot(w,data) gives the same
+    folded spectra as foldcal, in the same order. This allows folding data
+    that is read in blocks of time samples by accumulating the partial sums.
+
+    Parameters
+    ----------
+    n_ints : int
+        Number of time samples in the data
+    (See foldcal() for the other parameters)
+    '''
+    ONints,OFFints = diode_switches(tsamp,diode_p,numsamps)
+
+    weights = []
+    for ints in (ONints,OFFints):
+        w = np.zeros(n_ints)
+        n_valid = 0
+        for i in ints:
+            if i[1]!=i[0]:
+                w[i[0]:i[1]] += 1.0/(i[1]-i[0])
+                n_valid += 1
+        weights.append(w/n_valid)
+
+    #If switch=True, flip the order since ON is actually OFF
+    if switch:
+        return weights[1],weights[0]
+    return weights[0],weights[1]
+
+def foldcal_multi(arrs, tsamp, diode_p=0.04, numsamps=1000, switch=False, time_chunk=128):
+    '''
+    Folds several dynamic spectra (e.g. all four Stokes parameters) of the same
+    noise diode measurement at once. The diode switches are found once and each
+    array is traversed once, instead of calling foldcal on every array.
+    Returns two arrays of shape (len(arrs),...) with the spectra that foldcal
+    would return for each array, in the same order.
+
+    Parameters
+    ----------
+    arrs : 3D Array object (float) or sequence of 2D Array objects
+        Dynamic spectra with the same time axis, stacked along the first axis
+    time_chunk : int
+        Number of time samples folded at once, which bounds the temporary copies
+    (See foldcal() for the other parameters)
+    '''
+    n_ints = arrs[0].shape[0]
+    weights = np.stack(fold_weights(n_ints,tsamp,diode_p,numsamps,switch))
+
+    #Only time samples inside a diode interval contribute to the folds
+    used = np.flatnonzero(weights.any(axis=0))
+    start,stop = (used[0],used[-1]+1) if used.size else (0,0)
+
+    spec_shape = arrs[0].shape[1:]
+    spec_shape = tuple(n for n in spec_shape if n!=1)   #same as squeezing in foldcal
+    folded = np.zeros((2,len(arrs),int(np.prod(spec_shape))))
+
+    #Accumulate the folds block by block in the precision of the data, so
+    #no full size copy of any array is made
+    for k,arr in enumerate(arrs):
+        w = weights.astype(np.result_type(arr.dtype,np.float32))
+        for t0 in range(start,stop,time_chunk):
+            t1 = min(t0+time_chunk,stop)
+            folded[:,k] += np.dot(w[:,t0:t1],arr[t0:t1].reshape(t1-t0,-1))
+
+    shape = (len(arrs),)+spec_shape
+    return folded[0].reshape(shape), folded[1].reshape(shape)
+
 def integrate_chans(spec, chan_per_coarse):
     '''
     Integrates over each core channel of a given spectrum.
@@ -78,7 +164,7 @@ def integrate_chans(spec, chan_per_coarse):
         Number of frequency bins per coarse channel
     '''
 
-    num_coarse = spec.size/chan_per_coarse     #Calculate total number of coarse channels
+    num_coarse = spec.size//chan_per_coarse     #Calculate total number of coarse channels
 
     #Rearrange spectrum by coarse channel
     spec_shaped = np.array(np.reshape(spec,(num_coarse,chan_per_coarse)))
@@ -169,7 +255,7 @@ def get_centerfreqs(freqs,chan_per_coarse):
         Number of frequency bins per coarse channel
     '''
 
-    num_coarse = freqs.size/chan_per_coarse
+    num_coarse = freqs.size//chan_per_coarse
     freqs = np.reshape(freqs,(num_coarse,chan_per_coarse))
     return np.mean(freqs,axis=1)
 
@@ -217,9 +303,9 @@ def diode_spec(calON_obs,calOFF_obs,calflux,calfreq,spec_in,average=True,oneflux
     #Load frequencies and calculate number of channels per coarse channel
     obs = Waterfall(calON_obs,max_load=150)
     freqs = obs.container.populate_freqs()
-    ncoarse = obs.calc_n_coarse_chan()
+    ncoarse = int(obs.calc_n_coarse_chan())
     nchans = obs.header['nchans']
-    chan_per_coarse = nchans/ncoarse
+    chan_per_coarse = nchans//ncoarse
 
     f_ON, f_OFF = f_ratios(calON_obs,calOFF_obs,chan_per_coarse,**kwargs)
 
@@ -245,8 +331,8 @@ def get_Tsys(calON_obs, calOFF_obs, calflux, calfreq, spec_in, **kwargs):
     (See diode_spec())
     '''
     obs = Waterfall(calON_obs,max_load=150)
-    ncoarse = obs.calc_n_coarse_chan()
-    chan_per_coarse = obs.header['nchans']/ncoarse
+    ncoarse = int(obs.calc_n_coarse_chan())
+    chan_per_coarse = obs.header['nchans']//ncoarse
     freqs = obs.container.populate_freqs()
     cfreqs = get_centerfreqs(freqs,chan_per_coarse)
     S_sys = diode_spec(calON_obs,calOFF_obs,calflux,calfreq,spec_in,average=False,oneflux=False,**kwargs)[1]
@@ -274,8 +360,8 @@ def get_Tsys_nodiode(calON_obs_name, calOFF_obs_name, calflux, calfreq, spec_in)
     '''
     calON_obs = Waterfall(calON_obs_name,max_load=150)
     calOFF_obs = Waterfall(calOFF_obs_name,max_load=150)
-    ncoarse = calON_obs.calc_n_coarse_chan()
-    chan_per_coarse = calON_obs.header['nchans']/ncoarse
+    ncoarse = int(calON_obs.calc_n_coarse_chan())
+    chan_per_coarse = calON_obs.header['nchans']//ncoarse
 
     ONobs_spec = np.squeeze(np.mean(calON_obs.data,axis=0))
     OFFobs_spec = np.squeeze(np.mean(calOFF_obs.data,axis=0))
@@ -335,9 +421,9 @@ def calibrate_fluxes(main_obs_name,dio_name,dspec,Tsys,fullstokes=False,**kwargs
 
     #Find folded spectra of the target source with the noise diode ON and OFF
     main_obs = Waterfall(main_obs_name,max_load=150)
-    ncoarse = main_obs.calc_n_coarse_chan()
+    ncoarse = int(main_obs.calc_n_coarse_chan())
     dio_obs = Waterfall(dio_name,max_load=150)
-    dio_chan_per_coarse = dio_obs.header['nchans']/ncoarse
+    dio_chan_per_coarse = dio_obs.header['nchans']//ncoarse
     dOFF,dON = integrate_calib(dio_name,dio_chan_per_coarse,fullstokes,**kwargs)
 
     #Find Jy/count for each coarse channel using the diode spectrum
@@ -346,7 +432,7 @@ def calibrate_fluxes(main_obs_name,dio_name,dspec,Tsys,fullstokes=False,**kwargs
     print(scale_facs)
 
     nchans = main_obs.header['nchans']
-    obs_chan_per_coarse = nchans/ncoarse
+    obs_chan_per_coarse = nchans//ncoarse
 
     ax0_size = np.size(main_dat,0)
     ax1_size = np.size(main_dat,1)
@@ -1,78 +1,118 @@
 from blimpy import Waterfall
+import functools
 import numpy as np
-from .fluxcal import foldcal
+import numexpr as ne
+from .fluxcal import foldcal_multi, fold_weights
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    import cupy as cp
+    HAS_CUPY = True
+except ImportError:
+    HAS_CUPY = False
+
+#Stokes parameters (and total linear polarization L) as numexpr expressions of
+#the rawspec cross products XX, YY, Re(XY), Im(XY) (LL, RR, Re(RL), Im(RL) for
+#circular feeds), so each one is computed in a single fused pass
+_stokes_exprs = {
+    'l': {'I': 'XX+YY',                     #I = XX+YY
+          'Q': 'XX-YY',                     #Q = XX-YY
+          'U': '2*re',                      #U = 2*Re(XY)
+          'V': '-2*im',                     #V = -2*Im(XY)
+          'L': 'sqrt((XX-YY)**2+4*re**2)'}, #L = sqrt(Q^2+U^2)
+    'c': {'I': 'XX+YY',                     #I = LL+RR
+          'Q': '2*re',                      #Q = 2*Re(RL)
+          'U': '-2*im',                     #U = 2*Im(RL)
+          'V': 'YY-XX',                     #V = RR-LL
+          'L': '2*sqrt(re**2+im**2)'},      #L = sqrt(Q^2+U^2)
+}
+
+def _cross_products(cross_dat, feedtype='l'):
+    '''
+    Returns views of the four cross products of a rawspec cross polarization
+    data array, keeping the middle dimension to match Filterbank format
+    '''
+    if feedtype not in _stokes_exprs:
+        raise ValueError('feedtype must be \'l\' (linear) or \'c\' (circular)')
+
+    #rawspec products are 32-bit floats; keep all Stokes math in float32
+    if cross_dat.dtype != np.float32:
+        raise TypeError('cross_dat must be float32 rawspec products, got %s' % cross_dat.dtype)
+
+    return {'XX': cross_dat[:,0:1,:],
+            'YY': cross_dat[:,1:2,:],
+            're': cross_dat[:,2:3,:],
+            'im': cross_dat[:,3:4,:]}
+
+def _eval_stokes(products, name, feedtype='l', out=None):
+    '''
+    Computes one Stokes parameter ('I','Q','U','V' or 'L') from the cross products
+    '''
+    return ne.evaluate(_stokes_exprs[feedtype][name],local_dict=products,out=out)
+
+def _eval_stokes_blocks(products, names, feedtype='l', block_size=2**16):
+    '''
+    Computes several Stokes parameters that share cross products together, in
+    blocks of at most block_size elements of each product (small enough to stay
+    in cache), so each block of the shared products is read from memory once
+    for all of them
+    '''
+    n_ints,_,nchans = products['XX'].shape
+    cols = min(nchans,block_size)
+    rows = max(1,block_size//cols)
+    outs = [np.empty((n_ints,1,nchans),dtype=np.float32) for name in names]
+    for t0 in range(0,n_ints,rows):
+        for f0 in range(0,nchans,cols):
+            sl = (slice(t0,t0+rows),slice(None),slice(f0,f0+cols))
+            block = {key:arr[sl] for key,arr in products.items()}
+            for name,out in zip(names,outs):
+                _eval_stokes(block,name,feedtype,out=out[sl])
+    return outs
 
 def get_stokes(cross_dat, feedtype='l'):
     '''Output stokes parameters (I,Q,U,V) for a rawspec
     cross polarization filterbank file'''
 
-    #Compute Stokes Parameters
-    if feedtype=='l':
-        #I = XX+YY
-        I = cross_dat[:,0,:]+cross_dat[:,1,:]
-        #Q = XX-YY
-        Q = cross_dat[:,0,:]-cross_dat[:,1,:]
-        #U = 2*Re(XY)
-        U = 2*cross_dat[:,2,:]
-        #V = -2*Im(XY)
-        V = -2*cross_dat[:,3,:]
-
-    elif feedtype=='c':
-        #I = LL+RR
-        I = cross_dat[:,0,:]+cross_dat[:,1,:]
-        #Q = 2*Re(RL)
-        Q = 2*cross_dat[:,2,:]
-        #U = 2*Im(RL)
-        U = -2*cross_dat[:,3,:]
-        #V = RR-LL
-        V = cross_dat[:,1,:]-cross_dat[:,0,:]
-    else:
-        raise ValueError('feedtype must be \'l\' (linear) or \'c\' (circular)')
-
-    #Add middle dimension to match Filterbank format
-    I = np.expand_dims(I,axis=1)
-    Q = np.expand_dims(Q,axis=1)
-    U = np.expand_dims(U,axis=1)
-    V = np.expand_dims(V,axis=1)
-
-    #Compute linear polarization
-    #L=np.sqrt(np.square(Q)+np.square(U))
+    products = _cross_products(cross_dat,feedtype)
 
-    return I,Q,U,V
+    #Compute Stokes Parameters
+    return tuple(_eval_stokes(products,name,feedtype) for name in 'IQUV')
 
 def convert_to_coarse(data,chan_per_coarse):
     '''
     Converts a data array with length n_chans to an array of length n_coarse_chans
     by averaging over the coarse channels
     '''
-    #find number of coarse channels and reshape array
-    num_coarse = data.size/chan_per_coarse
-    data_shaped = np.array(np.reshape(data,(num_coarse,chan_per_coarse)))
-
-    #Return the average over each coarse channel
-    return np.mean(data_shaped[:,2:-1],axis=1)
-
-def phase_offsets(Idat,Qdat,Udat,Vdat,tsamp,chan_per_coarse,feedtype='l',**kwargs):
+    #Find number of coarse channels and view the array by coarse channel
+    #(a contiguous array reshapes without copying)
+    data = np.ascontiguousarray(data)
+    num_coarse = data.size//chan_per_coarse
+    data_shaped = data.reshape(num_coarse,chan_per_coarse)
+
+    #Return the average over each coarse channel, skipping the first two
+    #and last fine channels (float32 data stays float32, float64 stays float64)
+    coarse = np.empty(num_coarse,dtype=np.result_type(data.dtype,np.float32))
+    np.sum(data_shaped[:,2:-1],axis=1,out=coarse)
+    coarse /= (chan_per_coarse-3)
+    return coarse
+
+def _phase_offsets_folded(Qdiff,Udiff,Vdiff,chan_per_coarse,feedtype='l'):
     '''
-    Calculates phase difference between X and Y feeds given U and V (U and Q for circular basis)
-    data from a noise diode measurement on the target
+    Calculates coarse channel phase offsets from folded noise diode ON-OFF
+    spectra of U and V (Q and U for circular basis, the other may be None)
     '''
-    #Fold noise diode data and calculate ON OFF diferences for U and V
+    #Average the differences over each coarse channel before taking the angle,
+    #which avoids averaging angles across the arctan discontinuity
     if feedtype=='l':
-        U_OFF,U_ON = foldcal(Udat,tsamp,**kwargs)
-        V_OFF,V_ON = foldcal(Vdat,tsamp,**kwargs)
-        Udiff = U_ON-U_OFF
-        Vdiff = V_ON-V_OFF
-        poffset = np.arctan2(-1*Vdiff,Udiff)
+        coarse_p = np.arctan2(-1*convert_to_coarse(Vdiff,chan_per_coarse),convert_to_coarse(Udiff,chan_per_coarse))
 
     if feedtype=='c':
-        U_OFF,U_ON = foldcal(Udat,tsamp,**kwargs)
-        Q_OFF,Q_ON = foldcal(Qdat,tsamp,**kwargs)
-        Udiff = U_ON-U_OFF
-        Qdiff = Q_ON-Q_OFF
-        poffset = np.arctan2(Udiff,Qdiff)
-
-    coarse_p =  convert_to_coarse(poffset,chan_per_coarse)
+        coarse_p = np.arctan2(convert_to_coarse(Udiff,chan_per_coarse),convert_to_coarse(Qdiff,chan_per_coarse))
 
     #Correct for problems created by discontinuity in arctan
     #Find whether phase offsets have increasing or decreasing slope
@@ -86,16 +126,30 @@ def phase_offsets(Idat,Qdat,Udat,Vdat,tsamp,chan_per_coarse,feedtype='l',**kwarg
 
     return coarse_p
 
-def gain_offsets(Idat,Qdat,Udat,Vdat,tsamp,chan_per_coarse,feedtype='l',**kwargs):
+def phase_offsets(Idat,Qdat,Udat,Vdat,tsamp,chan_per_coarse,feedtype='l',**kwargs):
     '''
-    Determines relative gain error in the X and Y feeds for an
-    observation given I and Q (I and V for circular basis) noise diode data.
+    Calculates phase difference between X and Y feeds given U and V (U and Q for circular basis)
+    data from a noise diode measurement on the target
     '''
+    #Fold noise diode data and calculate ON OFF diferences for U and V
     if feedtype=='l':
-        #Fold noise diode data and calculate ON OFF differences for I and Q
-        I_OFF,I_ON = foldcal(Idat,tsamp,**kwargs)
-        Q_OFF,Q_ON = foldcal(Qdat,tsamp,**kwargs)
+        (U_OFF,V_OFF),(U_ON,V_ON) = foldcal_multi((Udat,Vdat),tsamp,**kwargs)
+        Udiff = U_ON-U_OFF
+        Vdiff = V_ON-V_OFF
+        return _phase_offsets_folded(None,Udiff,Vdiff,chan_per_coarse,feedtype)
 
+    if feedtype=='c':
+        (U_OFF,Q_OFF),(U_ON,Q_ON) = foldcal_multi((Udat,Qdat),tsamp,**kwargs)
+        Udiff = U_ON-U_OFF
+        Qdiff = Q_ON-Q_OFF
+        return _phase_offsets_folded(Qdiff,Udiff,None,chan_per_coarse,feedtype)
+
+def _gain_offsets_folded(I_OFF,Q_OFF,V_OFF,chan_per_coarse,feedtype='l'):
+    '''
+    Calculates coarse channel gain offsets from folded noise diode OFF
+    spectra of I and Q (I and V for circular basis, the other may be None)
+    '''
+    if feedtype=='l':
         #Calculate power in each feed for noise diode ON and OFF
         XX_OFF = (I_OFF+Q_OFF)/2
         YY_OFF = (I_OFF-Q_OFF)/2
@@ -104,10 +158,6 @@ def gain_offsets(Idat,Qdat,Udat,Vdat,tsamp,chan_per_coarse,feedtype='l',**kwargs
         G = (XX_OFF-YY_OFF)/(XX_OFF+YY_OFF)
 
     if feedtype=='c':
-        #Fold noise diode data and calculate ON OFF differences for I and Q
-        I_OFF,I_ON = foldcal(Idat,tsamp,**kwargs)
-        V_OFF,V_ON = foldcal(Vdat,tsamp,**kwargs)
-
         #Calculate power in each feed for noise diode ON and OFF
         RR_OFF = (I_OFF+V_OFF)/2
         LL_OFF = (I_OFF-V_OFF)/2
@@ -117,66 +167,251 @@ def gain_offsets(Idat,Qdat,Udat,Vdat,tsamp,chan_per_coarse,feedtype='l',**kwargs
 
     return convert_to_coarse(G,chan_per_coarse)
 
-def apply_Mueller(I,Q,U,V, gain_offsets, phase_offsets, chan_per_coarse, feedtype='l'):
+def gain_offsets(Idat,Qdat,Udat,Vdat,tsamp,chan_per_coarse,feedtype='l',**kwargs):
     '''
-    Returns calibrated Stokes parameters for an observation given an array
-    of differential gains and phase differences.
+    Determines relative gain error in the X and Y feeds for an
+    observation given I and Q (I and V for circular basis) noise diode data.
     '''
+    if feedtype=='l':
+        #Fold noise diode data and calculate ON OFF differences for I and Q
+        (I_OFF,Q_OFF),(I_ON,Q_ON) = foldcal_multi((Idat,Qdat),tsamp,**kwargs)
+        return _gain_offsets_folded(I_OFF,Q_OFF,None,chan_per_coarse,feedtype)
 
-    #Find shape of data arrays and calculate number of coarse channels
-    shape = I.shape
-    ax0 = I.shape[0]
-    ax1 = I.shape[1]
-    nchans = I.shape[2]
-    ncoarse = nchans/chan_per_coarse
-
-    #Reshape data arrays to separate coarse channels
-    I = np.reshape(I,(ax0,ax1,ncoarse,chan_per_coarse))
-    Q = np.reshape(Q,(ax0,ax1,ncoarse,chan_per_coarse))
-    U = np.reshape(U,(ax0,ax1,ncoarse,chan_per_coarse))
-    V = np.reshape(V,(ax0,ax1,ncoarse,chan_per_coarse))
-
-    #Swap axes 2 and 3 to in order for broadcasting to work correctly
-    I = np.swapaxes(I,2,3)
-    Q = np.swapaxes(Q,2,3)
-    U = np.swapaxes(U,2,3)
-    V = np.swapaxes(V,2,3)
+    if feedtype=='c':
+        #Fold noise diode data and calculate ON OFF differences for I and Q
+        (I_OFF,V_OFF),(I_ON,V_ON) = foldcal_multi((Idat,Vdat),tsamp,**kwargs)
+        return _gain_offsets_folded(I_OFF,None,V_OFF,chan_per_coarse,feedtype)
 
-    #Apply top left corner of electronics chain inverse Mueller matrix
+def _fold_diode(diode_cross,feedtype='l',time_chunk=128,**kwargs):
+    '''
+    Folds the Stokes parameters of a cross polarization noise diode measurement,
+    reading the file in blocks of time samples and accumulating the folded
+    spectra, so the whole measurement is never held in memory.
+    Returns the two folded spectra (in the order given by foldcal) as
+    (4,nchans) arrays of I,Q,U,V and the number of fine channels per
+    coarse channel.
+    '''
+    obs = Waterfall(diode_cross,load_data=False)
+    tsamp = obs.header['tsamp']
+    n_ints = obs.n_ints_in_file
+    nchans = obs.header['nchans']
+
+    #Calculate number of coarse channels in the noise diode measurement (usually 8)
+    ncoarse = int(obs.calc_n_coarse_chan())
+    chan_per_coarse = nchans//ncoarse
+
+    weights = np.stack(fold_weights(n_ints,tsamp,**kwargs))
+    folds = np.zeros((2,4,nchans))
+
+    #Only time samples inside a diode interval contribute to the folds
+    used = np.flatnonzero(weights.any(axis=0))
+    start,stop = (used[0],used[-1]+1) if used.size else (0,0)
+
+    if time_chunk is None:
+        time_chunk = n_ints
+    for t0 in range(start,stop,time_chunk):
+        t1 = min(t0+time_chunk,stop)
+        obs.read_data(t_start=t0,t_stop=t1)
+        for k,stokes in enumerate(get_stokes(obs.data,feedtype)):
+            folds[:,k] += np.dot(weights[:,t0:t1],stokes[:,0,:])
+
+    return folds[0],folds[1],chan_per_coarse
+
+if HAS_NUMBA:
+    @functools.lru_cache(maxsize=8)
+    def _get_mueller_kernel(chan_per_coarse):
+        '''
+        Returns a single pass inverse Mueller matrix kernel over (time, coarse
+        channel, fine channel) specialized to chan_per_coarse. The fine channel
+        count is a compile time constant of the closure so Numba can unroll and
+        vectorize the inner loop; rawspec products only use a few values, so the
+        JIT cost is paid once per resolution.
+        (A,B) is the pair mixed by the differential gain and (X,Y) the pair rotated
+        by the phase offset: I,Q and U,V for linear feeds, I,V and Q,U for circular.
+        '''
+        @njit(parallel=True, fastmath=True)
+        def kernel(A,B,X,Y,Acorr,Bcorr,Xcorr,Ycorr,a_per_coarse,ag_per_coarse,cos_per_coarse,sin_per_coarse):
+            ax0 = A.shape[0]
+            ncoarse = a_per_coarse.size
+            for t in prange(ax0):
+                for cc in range(ncoarse):
+                    a = a_per_coarse[cc]
+                    ag = ag_per_coarse[cc]
+                    c = cos_per_coarse[cc]
+                    s = sin_per_coarse[cc]
+                    for k in range(chan_per_coarse):
+                        ch = cc*chan_per_coarse+k
+                        i = A[t,0,ch]
+                        q = B[t,0,ch]
+                        u = X[t,0,ch]
+                        v = Y[t,0,ch]
+                        Acorr[t,0,ch] = a*i-ag*q
+                        Bcorr[t,0,ch] = -ag*i+a*q
+                        Xcorr[t,0,ch] = u*c-v*s
+                        Ycorr[t,0,ch] = u*s+v*c
+
+        return kernel
+
+if HAS_CUPY:
+    #One block per (coarse channel, time tile): the block loads the four
+    #coefficients of its coarse channel into shared memory once and its
+    #threads stride over the fine channels of every time sample in the tile
+    _mueller_raw = cp.RawKernel(r'''
+    extern "C" __global__
+    void mueller(const float* A, const float* B, const float* X, const float* Y,
+                 float* Acorr, float* Bcorr, float* Xcorr, float* Ycorr,
+                 const float* a, const float* ag, const float* c, const float* s,
+                 int n_ints, int nchans, int chan_per_coarse, int time_tile)
+    {
+        __shared__ float coeffs[4];
+        int cc = blockIdx.x;
+        if (threadIdx.x == 0) {
+            coeffs[0] = a[cc];
+            coeffs[1] = ag[cc];
+            coeffs[2] = c[cc];
+            coeffs[3] = s[cc];
+        }
+        __syncthreads();
+
+        int t_start = blockIdx.y*time_tile;
+        int t_stop = min(t_start+time_tile, n_ints);
+        for (int t = t_start; t < t_stop; t++) {
+            for (int k = threadIdx.x; k < chan_per_coarse; k += blockDim.x) {
+                size_t idx = (size_t)t*nchans + (size_t)cc*chan_per_coarse + k;
+                float i = A[idx];
+                float q = B[idx];
+                float u = X[idx];
+                float v = Y[idx];
+                Acorr[idx] = coeffs[0]*i - coeffs[1]*q;
+                Bcorr[idx] = -coeffs[1]*i + coeffs[0]*q;
+                Xcorr[idx] = u*coeffs[2] - v*coeffs[3];
+                Ycorr[idx] = u*coeffs[3] + v*coeffs[2];
+            }
+        }
+    }
+    ''', 'mueller')
+
+def _apply_mueller_gpu(A,B,X,Y,Acorr,Bcorr,Xcorr,Ycorr,a,ag,c,s,chan_per_coarse,time_tile=16,threads=256):
+    '''
+    CuPy version of the inverse Mueller matrix using the same (A,B),(X,Y)
+    pairs as _get_mueller_kernel. Data is copied to the GPU once, corrected
+    in a single kernel launch and copied back into the output arrays.
+    '''
+    if not HAS_CUPY:
+        raise RuntimeError("This method requires cupy")
+
+    n_ints = A.shape[0]
+    nchans = A.shape[-1]
+    ncoarse = nchans//chan_per_coarse
+    grid = (ncoarse,(n_ints+time_tile-1)//time_tile)
+    block = (min(threads,chan_per_coarse),)
+
+    data = [cp.ascontiguousarray(cp.asarray(arr,dtype=cp.float32)) for arr in (A,B,X,Y)]
+    coeffs = [cp.asarray(coeff,dtype=cp.float32) for coeff in (a,ag,c,s)]
+    corr = [cp.empty_like(arr) for arr in data]
+    _mueller_raw(grid,block,(*data,*corr,*coeffs,np.int32(n_ints),np.int32(nchans),
+                             np.int32(chan_per_coarse),np.int32(time_tile)))
+
+    for arr, arr_corr in zip((Acorr,Bcorr,Xcorr,Ycorr),corr):
+        arr[...] = arr_corr.get()
+
+def _precompute_mueller(gain_offsets, phase_offsets):
+    '''
+    Returns the coarse channel coefficients (a, a*gain, cos, sin) of the
+    electronics chain inverse Mueller matrix as float32 arrays
+    '''
     a = 1/(1-gain_offsets**2)
+    ag = a*gain_offsets
+    c = np.cos(phase_offsets)
+    s = np.sin(phase_offsets)
+
+    return a.astype(np.float32),ag.astype(np.float32),c.astype(np.float32),s.astype(np.float32)
+
+def _apply_mueller(I,Q,U,V, a, ag, c, s, chan_per_coarse, feedtype='l', backend='numexpr', out=None):
+    '''
+    Applies the inverse Mueller matrix to Stokes data given the coarse channel
+    coefficients from _precompute_mueller. If given, out is a tuple of four
+    arrays (e.g. views of a Filterbank data array) the corrected I,Q,U,V are
+    written into.
+    '''
+    if feedtype not in ('l','c'):
+        raise ValueError('feedtype must be \'l\' (linear) or \'c\' (circular)')
+    if backend not in ('numexpr','numba','gpu'):
+        raise ValueError('backend must be \'numexpr\', \'numba\' or \'gpu\'')
+
+    #Preallocate corrected arrays unless the caller provides them
+    if out is None:
+        out = (np.empty_like(I),np.empty_like(Q),np.empty_like(U),np.empty_like(V))
+    Icorr,Qcorr,Ucorr,Vcorr = out
+
+    if backend in ('numba','gpu'):
+        if backend=='numba':
+            if not HAS_NUMBA:
+                raise RuntimeError("This method requires numba")
+            kernel = _get_mueller_kernel(int(chan_per_coarse))
+        else:
+            kernel = functools.partial(_apply_mueller_gpu,chan_per_coarse=chan_per_coarse)
+        if feedtype=='l':
+            kernel(I,Q,U,V,Icorr,Qcorr,Ucorr,Vcorr,a,ag,c,s)
+        if feedtype=='c':
+            #Rotation of Q,U has the opposite sign to that of U,V for linear feeds
+            kernel(I,V,Q,U,Icorr,Vcorr,Qcorr,Ucorr,a,ag,c,-s)
+        return Icorr,Qcorr,Ucorr,Vcorr
+
+    #Repeat the coefficients over the fine channels so they broadcast
+    #against (ax0,ax1,nchans)
+    def fine_chans(coeffs):
+        return np.repeat(coeffs,chan_per_coarse)[np.newaxis,np.newaxis,:]
+
+    a = fine_chans(a)
+    ag = fine_chans(ag)
+    c = fine_chans(c)
+    s = fine_chans(s)
+
+    #Apply top left corner of electronics chain inverse Mueller matrix
     if feedtype=='l':
-        Icorr = a*(I-gain_offsets*Q)
-        Qcorr = a*(-1*gain_offsets*I+Q)
-        I = None
-        Q = None
+        ne.evaluate('a*I-ag*Q',out=Icorr)
+        ne.evaluate('-ag*I+a*Q',out=Qcorr)
     if feedtype=='c':
-        Icorr = a*(I-gain_offsets*V)
-        Vcorr = a*(-1*gain_offsets*I+V)
-        I = None
-        V = None
+        ne.evaluate('a*I-ag*V',out=Icorr)
+        ne.evaluate('-ag*I+a*V',out=Vcorr)
 
     #Apply bottom right corner of electronics chain inverse Mueller matrix
     if feedtype=='l':
-        Ucorr = U*np.cos(phase_offsets)-V*np.sin(phase_offsets)
-        Vcorr = U*np.sin(phase_offsets)+V*np.cos(phase_offsets)
-        U = None
-        V = None
+        ne.evaluate('U*c-V*s',out=Ucorr)
+        ne.evaluate('U*s+V*c',out=Vcorr)
     if feedtype=='c':
-        Qcorr = Q*np.cos(phase_offsets)+U*np.sin(phase_offsets)
-        Ucorr = -1*Q*np.sin(phase_offsets)+U*np.cos(phase_offsets)
-        Q = None
-        U = None
-
-    #Reshape arrays to original shape
-    Icorr = np.reshape(np.swapaxes(Icorr,2,3),shape)
-    Qcorr = np.reshape(np.swapaxes(Qcorr,2,3),shape)
-    Ucorr = np.reshape(np.swapaxes(Ucorr,2,3),shape)
-    Vcorr = np.reshape(np.swapaxes(Vcorr,2,3),shape)
+        ne.evaluate('Q*c+U*s',out=Qcorr)
+        ne.evaluate('-Q*s+U*c',out=Ucorr)
 
     #Return corrected data arrays
     return Icorr,Qcorr,Ucorr,Vcorr
 
-def calibrate_pols(cross_pols,diode_cross,obsI=None,onefile=True,feedtype='l',**kwargs):
+def apply_Mueller(I,Q,U,V, gain_offsets, phase_offsets, chan_per_coarse, feedtype='l', backend='numexpr'):
+    '''
+    Returns calibrated Stokes parameters for an observation given an array
+    of differential gains and phase differences.
+    Use backend='numba' for the multithreaded Numba kernel or
+    backend='gpu' to run the correction on a GPU with CuPy.
+    '''
+    a,ag,c,s = _precompute_mueller(gain_offsets,phase_offsets)
+    return _apply_mueller(I,Q,U,V,a,ag,c,s,chan_per_coarse,feedtype,backend)
+
+def _calibrate_in_place(cross_dat,a,ag,c,s,chan_per_coarse,feedtype='l',time_chunk=128,backend='numexpr'):
+    '''
+    Calibrates cross polarization data in blocks of time samples, overwriting
+    the cross products with the corrected Stokes parameters as it goes
+    '''
+    n_ints = cross_dat.shape[0]
+    if time_chunk is None:
+        time_chunk = n_ints
+    for t0 in range(0,n_ints,time_chunk):
+        chunk = cross_dat[t0:t0+time_chunk]
+        I,Q,U,V = get_stokes(chunk,feedtype)
+        _apply_mueller(I,Q,U,V,a,ag,c,s,chan_per_coarse,feedtype,backend,
+                       out=(chunk[:,0:1,:],chunk[:,1:2,:],chunk[:,2:3,:],chunk[:,3:4,:]))
+
+def calibrate_pols(cross_pols,diode_cross,obsI=None,onefile=True,feedtype='l',time_chunk=128,backend='numexpr',**kwargs):
     '''
     Write Stokes-calibrated filterbank file for a given observation
     with a calibrator noise diode measurement on the source
@@ -194,114 +429,102 @@ def calibrate_pols(cross_pols,diode_cross,obsI=None,onefile=True,feedtype='l',**
         False writes four separate files
     feedtype : 'l' or 'c'
         Basis of antenna dipoles. 'c' for circular, 'l' for linear
+    time_chunk : int
+        Number of time samples read from the noise diode measurement and calibrated at once;
+        None processes each file in one pass
+    backend : 'numexpr', 'numba' or 'gpu'
+        Implementation used to apply the Mueller matrix (see apply_Mueller)
     '''
-    #Obtain time sample length, frequencies, and noise diode data
-    obs = Waterfall(diode_cross,max_load=150)
-    cross_dat = obs.data
-    tsamp = obs.header['tsamp']
+    #Output files are named after the observation, assuming it is named *.cross_pols.fil
+    base = cross_pols[:-15]
 
-    #Calculate number of coarse channels in the noise diode measurement (usually 8)
-    dio_ncoarse = obs.calc_n_coarse_chan()
-    dio_nchans = obs.header['nchans']
-    dio_chan_per_coarse = dio_nchans/dio_ncoarse
-    obs = None
-    Idat,Qdat,Udat,Vdat = get_stokes(cross_dat,feedtype)
-    cross_dat = None
-    #Calculate differential gain and phase from noise diode measurements
+    #Fold noise diode data and calculate ON OFF differences
     print('Calculating Mueller Matrix variables')
-    gams = gain_offsets(Idat,Qdat,Udat,Vdat,tsamp,dio_chan_per_coarse,feedtype,**kwargs)
-    psis = phase_offsets(Idat,Qdat,Udat,Vdat,tsamp,dio_chan_per_coarse,feedtype,**kwargs)
+    OFFs,ONs,dio_chan_per_coarse = _fold_diode(diode_cross,feedtype,time_chunk,**kwargs)
+    I_OFF,Q_OFF,U_OFF,V_OFF = OFFs
+    I_ON,Q_ON,U_ON,V_ON = ONs
 
-    #Clear data arrays to save memory
-    Idat = None
-    Qdat = None
-    Udat = None
-    Vdat = None
+    #Calculate differential gain and phase from noise diode measurements
+    gams = _gain_offsets_folded(I_OFF,Q_OFF,V_OFF,dio_chan_per_coarse,feedtype)
+    psis = _phase_offsets_folded(Q_ON-Q_OFF,U_ON-U_OFF,V_ON-V_OFF,dio_chan_per_coarse,feedtype)
 
     #Get corrected Stokes parameters
     print('Opening '+cross_pols)
     cross_obs = Waterfall(cross_pols,max_load=150)
-    obs_ncoarse = cross_obs.calc_n_coarse_chan()
+    obs_ncoarse = int(cross_obs.calc_n_coarse_chan())
     obs_nchans = cross_obs.header['nchans']
-    obs_chan_per_coarse = obs_nchans/obs_ncoarse
-
-    print('Grabbing Stokes parameters')
-    I,Q,U,V = get_stokes(cross_obs.data,feedtype)
+    obs_chan_per_coarse = obs_nchans//obs_ncoarse
 
     print('Applying Mueller Matrix')
-    I,Q,U,V = apply_Mueller(I,Q,U,V,gams,psis,obs_chan_per_coarse,feedtype)
+    a,ag,c,s = _precompute_mueller(gams,psis)
+
+    cross_dat = cross_obs.data
+    _calibrate_in_place(cross_dat,a,ag,c,s,obs_chan_per_coarse,feedtype,time_chunk,backend)
 
     #Use onefile (default) to produce one filterbank file containing all Stokes information
     if onefile:
-        cross_obs.data[:,0,:] = np.squeeze(I)
-        cross_obs.data[:,1,:] = np.squeeze(Q)
-        cross_obs.data[:,2,:] = np.squeeze(U)
-        cross_obs.data[:,3,:] = np.squeeze(V)
-        cross_obs.write_to_fil(cross_pols[:-15]+'.SIQUV.polcal.fil')
-        print('Calibrated Stokes parameters written to '+cross_pols[:-15]+'.SIQUV.polcal.fil')
+        cross_obs.write_to_fil(base+'.SIQUV.polcal.fil')
+        print('Calibrated Stokes parameters written to '+base+'.SIQUV.polcal.fil')
         return
 
     # If onefile=False and obsI=None, abort
     assert obsI is not None
 
-    #Write corrected Stokes parameters to four filterbank files if onefile==False
+    #Write corrected Stokes parameters to four filterbank files if onefile==False,
+    #reusing one Waterfall header and views of the calibrated data
     obs = Waterfall(obsI,max_load=150)
-    obs.data = I
-    obs.write_to_fil(cross_pols[:-15]+'.SI.polcal.fil')   #assuming file is named *.cross_pols.fil
-    print('Calibrated Stokes I written to '+cross_pols[:-15]+'.SI.polcal.fil')
-
-    obs.data = Q
-    obs.write_to_fil(cross_pols[:-15]+'.Q.polcal.fil')   #assuming file is named *.cross_pols.fil
-    print('Calibrated Stokes Q written to '+cross_pols[:-15]+'.Q.polcal.fil')
-
-    obs.data = U
-    obs.write_to_fil(cross_pols[:-15]+'.U.polcal.fil')   #assuming file is named *.cross_pols.fil
-    print('Calibrated Stokes U written to '+cross_pols[:-15]+'.U.polcal.fil')
+    for k,name in enumerate(('SI','Q','U','V')):
+        obs.data = cross_dat[:,k:k+1,:]
+        obs.write_to_fil(base+'.'+name+'.polcal.fil')
+        print('Calibrated Stokes '+name[-1]+' written to '+base+'.'+name+'.polcal.fil')
 
-    obs.data = V
-    obs.write_to_fil(cross_pols[:-15]+'.V.polcal.fil')   #assuming file is named *.cross_pols.fil
-    print('Calibrated Stokes V written to '+cross_pols[:-15]+'.V.polcal.fil')
 
-
-def fracpols(cross_dat, **kwargs):
+def fracpols(cross_dat, feedtype='l'):
     '''Output fractional linear and circular polarizations for a
     rawspec cross polarization .fil file. NOT STANDARD USE'''
 
-    I,Q,U,V,L=get_stokes(cross_dat, **kwargs)
-    return L/I,V/I
+    #Divide straight from the cross products, without materializing I,Q,U,V or L
+    products = _cross_products(cross_dat, feedtype)
+    exprs = _stokes_exprs[feedtype]
+    lin = ne.evaluate('('+exprs['L']+')/('+exprs['I']+')', local_dict=products)
+    circ = ne.evaluate('('+exprs['V']+')/('+exprs['I']+')', local_dict=products)
+    return lin,circ
 
-def write_stokefils(cross_dat, str_I, Ifil=False, Qfil=False, Ufil=False, Vfil=False, Lfil=False, **kwargs):
+def write_stokefils(cross_dat, str_I, Ifil=False, Qfil=False, Ufil=False, Vfil=False, Lfil=False, feedtype='l'):
     '''Writes up to 5 new filterbank files corresponding to each Stokes
-    parameter (and total linear polarization L) for a given cross polarization .fil file'''
+    parameter (and total linear polarization L) for a given cross polarization .fil file.
+    Only the requested parameters are computed.'''
 
-    I,Q,U,V,L=get_stokes(cross_dat, **kwargs)
+    products = _cross_products(Waterfall(cross_dat, max_load=150).data, feedtype)
     obs = Waterfall(str_I, max_load=150) #Load filterbank file to write stokes data to
-    if Ifil:
-        obs.data = I
-        obs.write_to_fil(cross_dat[:-15]+'.I.fil')   #assuming file is named *.cross_pols.fil
-
-    if Qfil:
-        obs.data = Q
-        obs.write_to_fil(cross_dat[:-15]+'.Q.fil')   #assuming file is named *.cross_pols.fil
-
-    if Ufil:
-        obs.data = U
-        obs.write_to_fil(cross_dat[:-15]+'.U.fil')   #assuming file is named *.cross_pols.fil
-
-    if Vfil:
-        obs.data = V
-        obs.write_to_fil(cross_dat[:-15]+'.V.fil')   #assuming file is named *.cross_pols.fil
-
-    if Lfil:
-        obs.data = L
-        obs.write_to_fil(cross_dat[:-15]+'.L.fil')   #assuming file is named *.cross_pols.fil
-
 
-def write_polfils(cross_dat, str_I, **kwargs):
+    names = [name for flag, name in ((Ifil,'I'), (Qfil,'Q'), (Ufil,'U'), (Vfil,'V'), (Lfil,'L')) if flag]
+
+    #I is the sum of XX and YY and Q (V for circular feeds) their difference,
+    #so if both are requested compute them in one pass over XX and YY, at the
+    #cost of holding a second output buffer
+    pair = ('I', 'Q' if feedtype=='l' else 'V')
+    shared = {}
+    out = None
+    if all(name in names for name in pair):
+        shared = dict(zip(pair, _eval_stokes_blocks(products, pair, feedtype)))
+        out = shared['I']   #I is written first, so its buffer can be reused
+
+    #Each file is written right away, so the other parameters share one output buffer
+    for name in names:
+        if name in shared:
+            obs.data = shared[name]
+        else:
+            out = _eval_stokes(products, name, feedtype, out=out)
+            obs.data = out
+        obs.write_to_fil(cross_dat[:-15]+'.'+name+'.fil')   #assuming file is named *.cross_pols.fil
+
+
+def write_polfils(cross_dat, str_I, feedtype='l'):
     '''Writes two new filterbank files containing fractional linear and
-    circular polarization data'''
+    circular polarization data for a given cross polarization .fil file'''
 
-    lin,circ=fracpols(cross_dat, **kwargs)
+    lin,circ=fracpols(Waterfall(cross_dat, max_load=150).data, feedtype)
     obs = Waterfall(str_I, max_load=150)
 
     obs.data = lin
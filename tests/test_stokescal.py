@@ -0,0 +1,270 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from astropy.coordinates import Angle
+
+from blimpy import Waterfall
+from blimpy.calib_utils import fluxcal, stokescal
+from blimpy.io.sigproc import generate_sigproc_header
+
+# Short diode period and few switches so the folds cover small test arrays;
+# the last intervals run past the end of the data
+FOLD_KWARGS = dict(diode_p=0.04, numsamps=20)
+TSAMP = 0.01
+
+
+def make_cross_dat(n_ints=6, nchans=64):
+    rng = np.random.default_rng(1234)
+    return rng.uniform(1.0, 2.0, (n_ints, 4, nchans)).astype(np.float32)
+
+
+def write_cross_pols(filename, cross_dat, tsamp):
+    nchans = cross_dat.shape[-1]
+    header = {'telescope_id': 6, 'machine_id': 10, 'data_type': 1,
+              'source_name': 'test', 'barycentric': 0, 'pulsarcentric': 0,
+              'az_start': 0.0, 'za_start': 0.0, 'src_raj': Angle('1h0m0.0s'), 'src_dej': Angle('10d0m0.0s'),
+              'tstart': 58000.0, 'tsamp': tsamp, 'nbits': 32, 'fch1': 1500.0,
+              'foff': -4 * 2.9296875 / nchans, 'nchans': nchans, 'nifs': cross_dat.shape[1],
+              'ibeam': 1, 'nbeams': 1}
+    with open(filename, 'wb') as f:
+        f.write(generate_sigproc_header(SimpleNamespace(header=header)))
+        cross_dat.astype(np.float32).tofile(f)
+
+
+def test_get_stokes_linear():
+    cross_dat = make_cross_dat()
+    I, Q, U, V = stokescal.get_stokes(cross_dat, feedtype='l')
+    assert I.shape == (6, 1, 64)
+    assert I.dtype == np.float32
+    assert np.allclose(I[:, 0, :], cross_dat[:, 0, :] + cross_dat[:, 1, :])
+    assert np.allclose(Q[:, 0, :], cross_dat[:, 0, :] - cross_dat[:, 1, :])
+    assert np.allclose(U[:, 0, :], 2 * cross_dat[:, 2, :])
+    assert np.allclose(V[:, 0, :], -2 * cross_dat[:, 3, :])
+
+
+def test_get_stokes_circular():
+    cross_dat = make_cross_dat()
+    I, Q, U, V = stokescal.get_stokes(cross_dat, feedtype='c')
+    assert np.allclose(I[:, 0, :], cross_dat[:, 0, :] + cross_dat[:, 1, :])
+    assert np.allclose(Q[:, 0, :], 2 * cross_dat[:, 2, :])
+    assert np.allclose(U[:, 0, :], -2 * cross_dat[:, 3, :])
+    assert np.allclose(V[:, 0, :], cross_dat[:, 1, :] - cross_dat[:, 0, :])
+
+
+def test_get_stokes_bad_feedtype():
+    with pytest.raises(ValueError):
+        stokescal.get_stokes(make_cross_dat(), feedtype='x')
+
+
+def test_get_stokes_bad_dtype():
+    with pytest.raises(TypeError):
+        stokescal.get_stokes(make_cross_dat().astype(np.float64))
+
+
+@pytest.mark.parametrize('backend', ['numexpr', 'numba'])
+def test_apply_mueller_bad_feedtype(backend):
+    stokes = stokescal.get_stokes(make_cross_dat())
+    zeros = np.zeros(4)
+    with pytest.raises(ValueError):
+        stokescal.apply_Mueller(*stokes, zeros, zeros, 16, feedtype='x', backend=backend)
+
+
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_eval_stokes_shared_out(feedtype):
+    cross_dat = make_cross_dat()
+    I, Q, U, V = stokescal.get_stokes(cross_dat, feedtype=feedtype)
+    products = stokescal._cross_products(cross_dat, feedtype)
+    out = stokescal._eval_stokes(products, 'V', feedtype)
+    assert np.allclose(out, V)
+    L = stokescal._eval_stokes(products, 'L', feedtype, out=out)
+    assert L is out
+    assert np.allclose(L, np.sqrt(Q**2 + U**2), rtol=1e-5)
+
+
+@pytest.mark.parametrize('block_size', [24, 200])
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_eval_stokes_blocks(feedtype, block_size):
+    # 24 splits each row into ragged channel blocks, 200 takes ragged
+    # blocks of 3 full rows
+    cross_dat = make_cross_dat(n_ints=43)
+    products = stokescal._cross_products(cross_dat, feedtype)
+    outs = stokescal._eval_stokes_blocks(products, 'IQUV', feedtype, block_size=block_size)
+    for out, ref in zip(outs, stokescal.get_stokes(cross_dat, feedtype)):
+        assert np.allclose(out, ref)
+
+
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_write_stokefils(tmp_path, feedtype):
+    cross_dat = make_cross_dat()
+    cross_pols = str(tmp_path / 'obs.cross_pols.fil')
+    str_I = str(tmp_path / 'obs.I.in.fil')
+    write_cross_pols(cross_pols, cross_dat, 1.0)
+    write_cross_pols(str_I, cross_dat[:, :1, :], 1.0)
+    stokescal.write_stokefils(cross_pols, str_I, True, True, True, True, True,
+                              feedtype=feedtype)
+    I, Q, U, V = stokescal.get_stokes(cross_dat, feedtype)
+    expected = {'I': I, 'Q': Q, 'U': U, 'V': V, 'L': np.sqrt(Q**2 + U**2)}
+    for name, ref in expected.items():
+        data = Waterfall(str(tmp_path / ('obs.' + name + '.fil'))).data
+        assert np.allclose(data, ref, rtol=1e-5)
+
+
+def test_convert_to_coarse():
+    data = np.arange(32, dtype=np.float64)
+    coarse = stokescal.convert_to_coarse(data, 8)
+    assert coarse.shape == (4,)
+    assert coarse.dtype == np.float64
+    assert np.allclose(coarse, data.reshape(4, 8)[:, 2:-1].mean(axis=1))
+    assert stokescal.convert_to_coarse(data.astype(np.float32), 8).dtype == np.float32
+
+
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_apply_mueller_identity(feedtype):
+    I, Q, U, V = stokescal.get_stokes(make_cross_dat(), feedtype=feedtype)
+    zeros = np.zeros(4)
+    corr = stokescal.apply_Mueller(I, Q, U, V, zeros, zeros, 16, feedtype)
+    for stokes, stokes_corr in zip((I, Q, U, V), corr):
+        assert stokes_corr.shape == stokes.shape
+        assert np.allclose(stokes_corr, stokes)
+
+
+def mueller_reference(I, Q, U, V, gains, phases, chan_per_coarse, feedtype):
+    # Electronics chain inverse Mueller matrix written out directly
+    g = np.repeat(gains, chan_per_coarse)
+    c = np.repeat(np.cos(phases), chan_per_coarse)
+    s = np.repeat(np.sin(phases), chan_per_coarse)
+    a = 1 / (1 - g**2)
+    if feedtype == 'l':
+        return (a * (I - g * Q), a * (-g * I + Q),
+                U * c - V * s, U * s + V * c)
+    return (a * (I - g * V), Q * c + U * s,
+            -Q * s + U * c, a * (-g * I + V))
+
+
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_apply_mueller_reference(feedtype):
+    rng = np.random.default_rng(7)
+    gains = rng.uniform(-0.2, 0.2, 4)
+    phases = rng.uniform(-1.0, 1.0, 4)
+    stokes = stokescal.get_stokes(make_cross_dat(), feedtype=feedtype)
+    ref = mueller_reference(*stokes, gains, phases, 16, feedtype)
+    corr = stokescal.apply_Mueller(*stokes, gains, phases, 16, feedtype)
+    for stokes_ref, stokes_corr in zip(ref, corr):
+        assert np.allclose(stokes_corr, stokes_ref, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.skipif(not stokescal.HAS_NUMBA, reason='numba is not installed')
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_apply_mueller_numba(feedtype):
+    rng = np.random.default_rng(42)
+    gains = rng.uniform(-0.2, 0.2, 4)
+    phases = rng.uniform(-1.0, 1.0, 4)
+    stokes = stokescal.get_stokes(make_cross_dat(), feedtype=feedtype)
+    ref = stokescal.apply_Mueller(*stokes, gains, phases, 16, feedtype)
+    out = stokescal.apply_Mueller(*stokes, gains, phases, 16, feedtype, backend='numba')
+    for stokes_ref, stokes_out in zip(ref, out):
+        assert np.allclose(stokes_out, stokes_ref, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.skipif(not stokescal.HAS_CUPY, reason='cupy is not installed')
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_apply_mueller_gpu(feedtype):
+    rng = np.random.default_rng(42)
+    gains = rng.uniform(-0.2, 0.2, 4)
+    phases = rng.uniform(-1.0, 1.0, 4)
+    stokes = stokescal.get_stokes(make_cross_dat(), feedtype=feedtype)
+    ref = stokescal.apply_Mueller(*stokes, gains, phases, 16, feedtype)
+    out = stokescal.apply_Mueller(*stokes, gains, phases, 16, feedtype, backend='gpu')
+    for stokes_ref, stokes_out in zip(ref, out):
+        assert np.allclose(stokes_out, stokes_ref, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.skipif(not stokescal.HAS_NUMBA, reason='numba is not installed')
+def test_mueller_kernel_cached_per_chan_per_coarse():
+    kernel = stokescal._get_mueller_kernel(16)
+    assert stokescal._get_mueller_kernel(16) is kernel
+    assert stokescal._get_mueller_kernel(32) is not kernel
+
+
+BACKENDS = ['numexpr',
+            pytest.param('numba', marks=pytest.mark.skipif(
+                not stokescal.HAS_NUMBA, reason='numba is not installed')),
+            pytest.param('gpu', marks=pytest.mark.skipif(
+                not stokescal.HAS_CUPY, reason='cupy is not installed'))]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_calibrate_in_place_chunked(feedtype, backend):
+    # A time_chunk that does not divide the number of time samples leaves a
+    # ragged last chunk, and the outputs are strided views of the data
+    rng = np.random.default_rng(3)
+    gains = rng.uniform(-0.2, 0.2, 4)
+    phases = rng.uniform(-1.0, 1.0, 4)
+    coeffs = stokescal._precompute_mueller(gains, phases)
+    cross_dat = make_cross_dat(n_ints=6 * 7 + 1)
+    ref = stokescal._apply_mueller(*stokescal.get_stokes(cross_dat, feedtype),
+                                   *coeffs, 16, feedtype)
+    stokescal._calibrate_in_place(cross_dat, *coeffs, 16, feedtype,
+                                  time_chunk=7, backend=backend)
+    for k, stokes_ref in enumerate(ref):
+        assert np.allclose(cross_dat[:, k:k + 1, :], stokes_ref, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('switch', [False, True])
+def test_fold_weights_match_foldcal(switch):
+    data = make_cross_dat(n_ints=130)[:, :1, :]
+    weights = fluxcal.fold_weights(data.shape[0], TSAMP, switch=switch, **FOLD_KWARGS)
+    folds = fluxcal.foldcal(data, TSAMP, switch=switch, **FOLD_KWARGS)
+    for w, fold in zip(weights, folds):
+        assert np.allclose(np.dot(w, data[:, 0, :]), fold)
+
+
+@pytest.mark.parametrize('switch', [False, True])
+def test_foldcal_multi_matches_foldcal(switch):
+    stokes = stokescal.get_stokes(make_cross_dat(n_ints=130), feedtype='l')
+    first, second = fluxcal.foldcal_multi(stokes, TSAMP, switch=switch,
+                                          time_chunk=7, **FOLD_KWARGS)
+    assert first.shape == second.shape == (4, 64)
+    for k, arr in enumerate(stokes):
+        ref_first, ref_second = fluxcal.foldcal(arr, TSAMP, switch=switch, **FOLD_KWARGS)
+        assert np.allclose(first[k], ref_first)
+        assert np.allclose(second[k], ref_second)
+
+
+@pytest.mark.parametrize('n_ints', [130, 170])
+def test_fold_diode_time_chunk(tmp_path, n_ints):
+    # With 130 samples the last diode intervals run past the end of the data,
+    # with 170 the data runs past the last diode switch
+    filename = str(tmp_path / 'diode.cross_pols.fil')
+    cross_dat = make_cross_dat(n_ints=n_ints)
+    write_cross_pols(filename, cross_dat, TSAMP)
+    ref = stokescal._fold_diode(filename, time_chunk=None, **FOLD_KWARGS)
+    folds = fluxcal.foldcal_multi(stokescal.get_stokes(cross_dat), TSAMP, **FOLD_KWARGS)
+    assert np.allclose(ref[0], folds[0])
+    assert np.allclose(ref[1], folds[1])
+    for time_chunk in (1, 7, 64):
+        folds = stokescal._fold_diode(filename, time_chunk=time_chunk, **FOLD_KWARGS)
+        assert folds[2] == ref[2]
+        assert np.allclose(folds[0], ref[0])
+        assert np.allclose(folds[1], ref[1])
+
+
+def test_phase_offsets_near_wrap():
+    # Phase close to +-pi: fine channel angles alternate between the two
+    # branches of arctan, but the coarse channel phase must stay near pi
+    Udiff = -np.ones(128)
+    Vdiff = 0.01 * (-1) ** np.arange(128)
+    psis = stokescal._phase_offsets_folded(None, Udiff, Vdiff, 16, feedtype='l')
+    assert psis.shape == (8,)
+    assert np.allclose(np.abs(psis), np.pi, atol=0.01)
+
+
+@pytest.mark.parametrize('feedtype', ['l', 'c'])
+def test_fracpols(feedtype):
+    cross_dat = make_cross_dat()
+    I, Q, U, V = stokescal.get_stokes(cross_dat, feedtype=feedtype)
+    lin, circ = stokescal.fracpols(cross_dat, feedtype=feedtype)
+    assert np.allclose(lin, np.sqrt(Q**2 + U**2) / I, rtol=1e-5)
+    assert np.allclose(circ, V / I, rtol=1e-5)